@@ -1,22 +1,29 @@
+import functools
 import io
 import json
 import os
+import queue
 import re
-import sys
-import tempfile
+import threading
+import time
+from concurrent.futures import Future
 from typing import Any
 
 import boto3
-import geopy.distance
-from llava.eval.run_llava import eval_model
-from llava.mm_utils import get_model_name_from_path
+import numpy as np
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from loguru import logger
 from opencage.geocoder import OpenCageGeocode
+from PIL import Image
 from types_boto3_s3.client import S3Client
 
 from inukai.validate.validation_classes import CriteriaResult, ValidationResult
 
 MODELPATH = "liuhaotian/llava-v1.5-7b"
+# vLLM serves the Hugging Face conversion of the same checkpoint
+VLLM_MODELPATH = "llava-hf/llava-1.5-7b-hf"
+VLLM_PROMPTTEMPLATE = "USER: <image>\n{prompt}\nASSISTANT:"
 PROMPTTEMPLATE = (
     "There is an object in the image. Someone has claimed it is a {object}. \
                   Can you confirm the object in the image is a {object} and it is fully captured in the image? \
@@ -24,55 +31,337 @@ PROMPTTEMPLATE = (
                   object: True/False, fully captured: True/False"
 )
 
+LLM_RESPONSE_RE = re.compile(
+    r"object:\s*(True|False),\s*fully captured:\s*(True|False)", re.IGNORECASE
+)
+
+EARTH_RADIUS = 6371008.8  # mean Earth radius in meters
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+# Photos above the threshold are fetched as parallel ranged GETs
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
+_SESSION = boto3.session.Session()
+_CLIENT_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _create_client(service_name: str, region_name: str | None) -> Any:
+    return _SESSION.client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+
+
+def get_client(service_name: str, region_name: str | None = None) -> Any:
+    """
+    Return a boto3 client shared across processors, so connection pools and
+    credentials are only set up once per service and region.
+    """
+    # boto3 sessions are not thread-safe, clients created from them are
+    with _CLIENT_LOCK:
+        return _create_client(service_name, region_name)
+
+
+def haversine_distance(
+    lat1: float | np.ndarray,
+    lon1: float | np.ndarray,
+    lat2: float | np.ndarray,
+    lon2: float | np.ndarray,
+) -> float | np.ndarray:
+    """
+    Great-circle distance in meters between points given in degrees. Arrays
+    broadcast, so many photos can be checked against an address at once.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@functools.lru_cache(maxsize=4096)
+def geocode_address(
+    address: str, geocode_key: str
+) -> tuple[float | None, float | None]:
+    """
+    Use OpenCage API to get the latitude and longitude of an address. Results
+    are cached, so repeated addresses only cost one request per process.
+    """
+    result = OpenCageGeocode(geocode_key).geocode(address)
+    if result:
+        return result[0]["geometry"]["lat"], result[0]["geometry"]["lng"]
+    return None, None
+
 
 def read_json_from_s3(bucket_name: str, file_key: str, s3: S3Client) -> dict[str, Any]:
     """
     Read a JSON file from S3 and returns the data.
     """
     obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-    data = json.loads(obj["Body"].read().decode("utf-8"))
+    data = json.load(obj["Body"])
     return data
 
 
+@functools.lru_cache(maxsize=128)
+def _read_json_version(
+    bucket_name: str, file_key: str, etag: str, s3: S3Client
+) -> dict[str, Any]:
+    # IfMatch makes sure the cached data really belongs to this ETag
+    obj = s3.get_object(Bucket=bucket_name, Key=file_key, IfMatch=etag)
+    return json.load(obj["Body"])
+
+
+def read_cached_json_from_s3(
+    bucket_name: str, file_key: str, s3: S3Client
+) -> dict[str, Any]:
+    """
+    Read a JSON file from S3, reusing the parsed data for as long as the
+    object's ETag stays the same. Callers must not modify the returned data.
+    """
+    etag = s3.head_object(Bucket=bucket_name, Key=file_key)["ETag"]
+    return _read_json_version(bucket_name, file_key, etag, s3)
+
+
 def get_image_data(
     photo_address: dict[str, str | dict[str, float]], s3: S3Client
-) -> tuple[bytes, dict[str, float]]:
+) -> tuple[io.BytesIO, dict[str, float]]:
     """
-    Retrieve image data from S3.
+    Retrieve image data from S3 into an in-memory buffer.
     """
     bucket_name = photo_address["s3_bucket"]
     filename = photo_address["filename"]
-    response = s3.get_object(Bucket=bucket_name, Key=filename)
+    buffer = io.BytesIO()
+    s3.download_fileobj(bucket_name, filename, buffer, Config=TRANSFER_CONFIG)
+    buffer.seek(0)
     geotag = photo_address["geotag"]
-    return response["Body"].read(), geotag
+    return buffer, geotag
 
 
 def parse_llm_response(response: str) -> tuple[bool, bool]:
     """
     Use regex to capture True/False values for 'object' and 'fully captured'
     """
-    match = re.search(r"object: (\w+), fully captured: (\w+)", response)
+    match = LLM_RESPONSE_RE.search(response)
     if match:
-        object_status = match.group(1) == "True"
-        fully_captured_status = match.group(2) == "True"
+        object_status = match.group(1).lower() == "true"
+        fully_captured_status = match.group(2).lower() == "true"
         return object_status, fully_captured_status
     else:
         raise ValueError("Response format is incorrect")
 
 
-def capture_eval_model_output(args):
+_LLAVA_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_llava(path: str = MODELPATH) -> tuple[Any, Any, Any, int]:
+    # Imported here so the S3 and geocoding helpers do not pull in torch
+    from llava.mm_utils import get_model_name_from_path
+    from llava.model.builder import load_pretrained_model
+
+    tokenizer, model, image_processor, context_len = load_pretrained_model(
+        path, None, get_model_name_from_path(path)
+    )
+    # Batched generation needs the prompts padded on the left
+    model.config.tokenizer_padding_side = "left"
+    return tokenizer, model, image_processor, context_len
+
+
+def get_llava(path: str = MODELPATH) -> tuple[Any, Any, Any, int]:
+    """
+    Return LLaVA's tokenizer, model and image processor, loading the weights
+    only on the first call.
+    """
+    # lru_cache does not stop concurrent first callers from loading twice
+    with _LLAVA_LOCK:
+        return _load_llava(path)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_vllm(path: str = VLLM_MODELPATH) -> Any:
+    # Only needed when the vLLM backend is selected
+    from vllm import LLM
+
+    return LLM(
+        model=path,
+        quantization=os.getenv("LLAVA_QUANTIZATION"),
+        dtype="float16",
+        max_model_len=2048,
+        gpu_memory_utilization=0.9,
+    )
+
+
+def get_vllm(path: str = VLLM_MODELPATH) -> Any:
+    """
+    Return the vLLM engine for LLaVA, creating it on the first call.
+    """
+    with _LLAVA_LOCK:
+        return _load_vllm(path)
+
+
+def generate_vllm_responses(
+    images: list[Image.Image], prompts: list[str], max_new_tokens: int = 32
+) -> list[str]:
+    """
+    Run a batch of images and prompts through LLaVA served by vLLM.
+    """
+    from vllm import SamplingParams
+
+    outputs = get_vllm().generate(
+        [
+            {
+                "prompt": VLLM_PROMPTTEMPLATE.format(prompt=prompt),
+                "multi_modal_data": {"image": image},
+            }
+            for image, prompt in zip(images, prompts)
+        ],
+        SamplingParams(temperature=0, max_tokens=max_new_tokens),
+        use_tqdm=False,
+    )
+    return [output.outputs[0].text.strip() for output in outputs]
+
+
+def generate_llava_responses(
+    images: list[Image.Image], prompts: list[str], max_new_tokens: int = 32
+) -> list[str]:
     """
-    Create a string buffer to capture LLaVa's output
+    Run a batch of images and prompts through LLaVA in a single generate call.
+    Set LLAVA_BACKEND=vllm to use vLLM instead of the Hugging Face model, and
+    LLAVA_QUANTIZATION (e.g. "fp8") to quantize it.
     """
-    captured_output = io.StringIO()
-    original_stdout = sys.stdout
-    try:
-        sys.stdout = captured_output
-        eval_model(args)
-        response = captured_output.getvalue().strip()
-    finally:
-        sys.stdout = original_stdout
-    return response
+    if os.getenv("LLAVA_BACKEND") == "vllm":
+        return generate_vllm_responses(images, prompts, max_new_tokens)
+
+    import torch
+    from llava.constants import (
+        DEFAULT_IM_END_TOKEN,
+        DEFAULT_IM_START_TOKEN,
+        DEFAULT_IMAGE_TOKEN,
+        IMAGE_TOKEN_INDEX,
+    )
+    from llava.conversation import conv_templates
+    from llava.mm_utils import process_images, tokenizer_image_token
+
+    tokenizer, model, image_processor, _ = get_llava()
+
+    image_token = DEFAULT_IMAGE_TOKEN
+    if model.config.mm_use_im_start_end:
+        image_token = DEFAULT_IM_START_TOKEN + image_token + DEFAULT_IM_END_TOKEN
+
+    sequences = []
+    for prompt in prompts:
+        conv = conv_templates["llava_v1"].copy()
+        conv.append_message(conv.roles[0], f"{image_token}\n{prompt}")
+        conv.append_message(conv.roles[1], None)
+        sequences.append(
+            tokenizer_image_token(
+                conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt"
+            )
+        )
+
+    max_len = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full(
+        (len(sequences), max_len), tokenizer.pad_token_id, dtype=torch.long
+    )
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.bool)
+    for i, sequence in enumerate(sequences):
+        input_ids[i, max_len - len(sequence) :] = sequence
+        attention_mask[i, max_len - len(sequence) :] = True
+
+    images_tensor = process_images(images, image_processor, model.config).to(
+        model.device, dtype=torch.float16
+    )
+
+    with torch.inference_mode():
+        output_ids = model.generate(
+            input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            images=images_tensor,
+            image_sizes=[image.size for image in images],
+            do_sample=False,
+            num_beams=1,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+        )
+    return [
+        output.strip()
+        for output in tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+    ]
+
+
+class BatchedLlavaRunner:
+    """
+    Micro-batch LLaVA requests from concurrent callers. Requests are queued and
+    a single worker thread runs them through the model in batches of at most
+    max_batch_size, waiting at most max_wait seconds for a batch to fill up.
+    """
+
+    max_batch_size: int
+    max_wait: float
+    max_new_tokens: int
+    _requests: "queue.Queue[tuple[Image.Image, str, Future[str]]]"
+    _worker: threading.Thread | None
+    _lock: threading.Lock
+
+    def __init__(
+        self, max_batch_size: int = 16, max_wait: float = 0.05, max_new_tokens: int = 32
+    ) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self._requests = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, image: Image.Image, prompt: str) -> "Future[str]":
+        """
+        Queue an image and a prompt, the future resolves to the model's answer.
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        future: Future[str] = Future()
+        self._requests.put((image, prompt, future))
+        return future
+
+    def _next_batch(self) -> list[tuple[Image.Image, str, "Future[str]"]]:
+        """
+        Block for the first request, then collect more until the batch is full
+        or the wait time has passed.
+        """
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                responses = generate_llava_responses(
+                    [image for image, _, _ in batch],
+                    [prompt for _, prompt, _ in batch],
+                    self.max_new_tokens,
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), response in zip(batch, responses):
+                future.set_result(response)
+
+
+LLAVA_RUNNER = BatchedLlavaRunner()
 
 
 class ApplicationFormProcessor:
@@ -82,6 +371,8 @@ class ApplicationFormProcessor:
     geocode_key: str
     radius: int
     s3: S3Client
+    image_data: io.BytesIO | None
+    llava_runner: BatchedLlavaRunner | None
 
     def __init__(
         self,
@@ -89,15 +380,23 @@ class ApplicationFormProcessor:
         photo_address: dict[str, str | dict[str, float]],
         geocode_key: str,
         radius: int = 500,
+        s3: S3Client | None = None,
+        application_form: dict[str, Any] | None = None,
+        image_data: io.BytesIO | None = None,
+        llava_runner: BatchedLlavaRunner | None = None,
     ) -> None:
-        self.s3 = boto3.client("s3")
+        self.s3 = s3 if s3 is not None else get_client("s3")
         self.application_form_address = application_form_address
         self.photo_address = photo_address
-        self.application_form = read_json_from_s3(
-            application_form_address["s3_bucket"],
-            application_form_address["filename"],
-            self.s3,
-        )
+        if application_form is None:
+            application_form = read_json_from_s3(
+                application_form_address["s3_bucket"],
+                application_form_address["filename"],
+                self.s3,
+            )
+        self.application_form = application_form
+        self.image_data = image_data
+        self.llava_runner = llava_runner
         self.geocode_key = geocode_key
         self.radius = radius
 
@@ -107,30 +406,40 @@ class ApplicationFormProcessor:
         """
         Validates geotag information against the address coordinates within a given radius.
         """
-        geotag_coords = (geotag["latitude"], geotag["longitude"])
-        address_coords = (address_lat, address_lon)
-        distance = geopy.distance.geodesic(geotag_coords, address_coords).meters
+        distance = float(
+            haversine_distance(
+                geotag["latitude"], geotag["longitude"], address_lat, address_lon
+            )
+        )
         return distance <= self.radius, distance
 
     def get_address_coordinates(self) -> tuple[float | None, float | None]:
         """
         Use OpenCage API to get the latitude and longitude of an address.
         """
-        geocoder = OpenCageGeocode(self.geocode_key)
-        result = geocoder.geocode(self.application_form["address"])
-        if result:
-            return result[0]["geometry"]["lat"], result[0]["geometry"]["lng"]
-        else:
+        address_lat, address_lon = geocode_address(
+            self.application_form["address"], self.geocode_key
+        )
+        if address_lat is None:
             logger.error(f"Address not found: {self.application_form['address']}")
-            return None, None
+        return address_lat, address_lon
 
-    def validate_photo(self) -> ValidationResult:
+    def validate_photo(self, fast_fail: bool = False) -> ValidationResult:
         """
-        Validate the image and geotag data against the application form
+        Validate the image and geotag data against the application form. With
+        fast_fail, the image check is skipped when the geotag check fails.
         """
         validation_result = ValidationResult(component_name="ApplicationForm")
-        image_data, geotag = get_image_data(self.photo_address, self.s3)
-        validation_result.add_criteria(self.validate_geotag_address(geotag))
+        if self.image_data is not None:
+            image_data, geotag = self.image_data, self.photo_address["geotag"]
+        else:
+            image_data, geotag = get_image_data(self.photo_address, self.s3)
+        geotag_result = self.validate_geotag_address(geotag)
+        validation_result.add_criteria(geotag_result)
+        if fast_fail and not geotag_result.score():
+            logger.info("Geotag check failed, skipping the image check.")
+            validation_result.add_criteria(CriteriaResult("image", False, weight=0))
+            return validation_result
         validation_result.add_criteria(self.validate_image_contains_object(image_data))
         return validation_result
 
@@ -156,63 +465,38 @@ class ApplicationFormProcessor:
             )
             return CriteriaResult(key="geotag_address", value="False")
 
-    def validate_image_contains_object(self, image_data: bytes) -> CriteriaResult:
+    def validate_image_contains_object(self, image_data: io.BytesIO) -> CriteriaResult:
         """
         Validate if the image associated with the application contains the specified object.
         """
         prompt = PROMPTTEMPLATE.format(object=self.application_form["item_name"])
 
         try:
-            # Write the image data to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-                tmp_file.write(image_data)
-                temp_file_path = tmp_file.name
-        except IOError as e:
-            logger.critical(f"Failed to write image data to a temporary file: {e}")
+            image = Image.open(image_data).convert("RGB")
+        except OSError as e:
+            logger.critical(f"Failed to decode image data: {e}")
             return CriteriaResult("image", False, weight=1)
 
         try:
             # Describe the image and analyze the result
-            object_status, fully_captured_status = self.describe_image(
-                temp_file_path, prompt
-            )
-        except RuntimeError as e:
+            object_status, fully_captured_status = self.describe_image(image, prompt)
+        except (RuntimeError, ValueError) as e:
+            # ValueError covers replies that don't follow the requested format,
+            # e.g. "Yes"/"No" answers or output cut off at max_new_tokens
             logger.error(f"Error during image description: {e}")
             object_status, fully_captured_status = False, False
-        finally:
-            # Ensure the temporary file is cleaned up
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                except OSError as e:
-                    logger.warning(
-                        f"Failed to remove temporary file {temp_file_path}: {e}"
-                    )
 
         return CriteriaResult(
             "image", object_status and fully_captured_status, weight=1
         )
 
-    def describe_image(self, image_file_path: str, prompt: str) -> tuple[bool, bool]:
+    def describe_image(self, image: Image.Image, prompt: str) -> tuple[bool, bool]:
         """
         Use LLaVA to generate a description for the given image.
         """
-        args = type(
-            "Args",
-            (),
-            {
-                "model_path": MODELPATH,
-                "model_base": None,
-                "model_name": get_model_name_from_path(MODELPATH),
-                "query": prompt,
-                "conv_mode": None,
-                "image_file": image_file_path,
-                "sep": ",",
-                "temperature": 0,
-                "top_p": None,
-                "num_beams": 1,
-                "max_new_tokens": 512,
-            },
-        )()
-        response = capture_eval_model_output(args)
+        if self.llava_runner is not None:
+            response = self.llava_runner.submit(image, prompt).result()
+            return parse_llm_response(response)
+
+        response = generate_llava_responses([image], [prompt])[0]
         return parse_llm_response(response)
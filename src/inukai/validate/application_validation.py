@@ -1,14 +1,20 @@
+import io
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any
 
-import boto3
 import click
 from dotenv import load_dotenv
 from loguru import logger
 from types_boto3_s3.client import S3Client
 
 from inukai.validate.application_form_validator import (
+    LLAVA_RUNNER,
     ApplicationFormProcessor,
+    get_client,
+    get_image_data,
     read_json_from_s3,
 )
 from inukai.validate.bank_statement_validation import BankStatementProcessor
@@ -18,6 +24,7 @@ from inukai.validate.validation_classes import ValidationResult
 # Access the API key
 load_dotenv()
 GEOCODE_KEY = os.getenv("GEOCODE_KEY")
+LLAMA_URL = os.getenv("LLAMA_URL", "http://localhost:8000")
 
 REGION = "eu-west-2"
 
@@ -41,6 +48,35 @@ ERROR_MSGS = {
 }
 
 
+@dataclass
+class FetchedArtifacts:
+    application_form: dict[str, Any]
+    image_data: io.BytesIO
+
+
+def fetch_artifacts(
+    application_form_address: dict[str, str],
+    photo_address: dict[str, str | dict[str, float]],
+    s3: S3Client,
+) -> FetchedArtifacts:
+    """
+    Fetch the application form and the photo from S3 in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        application_form_future = executor.submit(
+            read_json_from_s3,
+            application_form_address["s3_bucket"],
+            application_form_address["filename"],
+            s3,
+        )
+        image_future = executor.submit(get_image_data, photo_address, s3)
+        image_data, _ = image_future.result()
+        return FetchedArtifacts(
+            application_form=application_form_future.result(),
+            image_data=image_data,
+        )
+
+
 def calculate_confidence_score(
     application_form_validation_result: ValidationResult,
     bank_statement_validation_result: ValidationResult,
@@ -86,7 +122,8 @@ def log_feedback(
         invoice_validation_result,
     ]:
         for criteria in validation_result.criteria:
-            if not criteria.score():
+            # Zero-weight criteria were skipped, not failed
+            if criteria.weight and not criteria.score():
                 logger.error(ERROR_MSGS[criteria.key])
 
     logger.info(f"confidence score: {feedback_score}")
@@ -97,29 +134,43 @@ class Application:
     invoice_address: dict[str, str]
     bank_statement_address: dict[str, str]
     photo_address: dict[str, str | dict[str, float]]
+    artifacts: FetchedArtifacts
+    fast_fail: bool
     s3: S3Client
 
-    def __init__(self, bucket_name: str, file_key: str) -> None:
-        self.s3 = boto3.client("s3")
+    def __init__(
+        self, bucket_name: str, file_key: str, fast_fail: bool = False
+    ) -> None:
+        self.s3 = get_client("s3")
         application = read_json_from_s3(bucket_name, file_key, self.s3)
         self.application_form_address = application["application_form_address"]
         self.invoice_address = application["invoice_address"]
         self.bank_statement_address = application["bank_statement_address"]
         self.photo_address = application["photo_address"]
+        self.fast_fail = fast_fail
+        self.artifacts = fetch_artifacts(
+            self.application_form_address, self.photo_address, self.s3
+        )
 
     def validate_application_form(self) -> ValidationResult:
         validator = ApplicationFormProcessor(
             application_form_address=self.application_form_address,
             photo_address=self.photo_address,
             geocode_key=GEOCODE_KEY,
+            s3=self.s3,
+            application_form=self.artifacts.application_form,
+            image_data=self.artifacts.image_data,
+            llava_runner=LLAVA_RUNNER,
         )
-        return validator.validate_photo()
+        return validator.validate_photo(fast_fail=self.fast_fail)
 
     def validate_bank_statement(self) -> ValidationResult:
         validator = BankStatementProcessor(
             application_form_address=self.application_form_address,
             bank_statement_address=self.bank_statement_address,
             region_name=REGION,
+            s3=self.s3,
+            application_form=self.artifacts.application_form,
         )
         return validator.validate_statement()
 
@@ -129,13 +180,25 @@ class Application:
             invoice_address=self.invoice_address,
             region_name=REGION,
             queries=QUERIES,
+            llama_url=LLAMA_URL,
+            s3=self.s3,
+            application_form=self.artifacts.application_form,
         )
         validation_result = invoice_processor.run_invoice_processing()
         return validation_result
 
 
+def abort() -> None:
+    """
+    Exit with status 1 straight away. sys.exit would wait for the validators
+    still running in worker threads, e.g. a Textract job being polled
+    """
+    sys.stderr.flush()
+    os._exit(1)
+
+
 @logger.catch(reraise=True)
-def main(bucket_name, file_key, log_level):
+def main(bucket_name, file_key, log_level, fast_fail=False):
     """
     Validate the application form, bank statement, and invoice using the provided BUCKET_NAME and FILE_KEY.
     """
@@ -147,47 +210,42 @@ def main(bucket_name, file_key, log_level):
     logger.debug(f"Received bucket_name: {bucket_name}, file_key: {file_key}")
 
     try:
-        application = Application(bucket_name, file_key)
+        application = Application(bucket_name, file_key, fast_fail=fast_fail)
     except Exception as e:
         logger.error(f"Failed to initialize the application object: {e}")
         sys.exit(1)
 
-    try:
-        logger.info("Validating application form...")
-        application_form_validation_result = application.validate_application_form()
-        logger.success("Application form validation complete.")
-    except ValueError as e:
-        logger.error(f"Application form validation failed: {e}")
-        sys.exit(1)
-    except Exception as e:
-        logger.error(
-            f"An unexpected error occurred during application form validation: {e}"
-        )
-        sys.exit(1)
+    # The validators only share read-only state, so their S3, Textract, geocoding
+    # and model calls can overlap
+    executor = ThreadPoolExecutor(max_workers=3)
+    logger.info("Validating application form, bank statement and invoice...")
+    futures = {
+        executor.submit(application.validate_application_form): "Application form",
+        executor.submit(application.validate_bank_statement): "Bank statement",
+        executor.submit(application.validate_invoice): "Invoice",
+    }
 
-    try:
-        logger.info("Validating bank statement...")
-        bank_statement_validation_result = application.validate_bank_statement()
-        logger.success("Bank statement validation complete.")
-    except ValueError as e:
-        logger.error(f"Bank statement validation failed: {e}")
-        sys.exit(1)
-    except Exception as e:
-        logger.error(
-            f"An unexpected error occurred during bank statement validation: {e}"
-        )
-        sys.exit(1)
+    # Report results as they finish, so a fast failure is not held up behind
+    # a slow validator
+    validation_results = {}
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            validation_results[name] = future.result()
+            logger.success(f"{name} validation complete.")
+        except ValueError as e:
+            logger.error(f"{name} validation failed: {e}")
+            abort()
+        except Exception as e:
+            logger.error(
+                f"An unexpected error occurred during {name.lower()} validation: {e}"
+            )
+            abort()
+    executor.shutdown()
 
-    try:
-        logger.info("Validating invoice...")
-        invoice_validation_result = application.validate_invoice()
-        logger.success("Invoice validation complete.")
-    except ValueError as e:
-        logger.error(f"Invoice validation failed: {e}")
-        sys.exit(1)
-    except Exception as e:
-        logger.error(f"An unexpected error occurred during invoice validation: {e}")
-        sys.exit(1)
+    application_form_validation_result = validation_results["Application form"]
+    bank_statement_validation_result = validation_results["Bank statement"]
+    invoice_validation_result = validation_results["Invoice"]
 
     try:
         logger.info("Printing feedback...")
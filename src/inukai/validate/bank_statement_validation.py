@@ -1,16 +1,23 @@
+import re
+import time
+import warnings
 from collections import defaultdict
 from datetime import date
 from typing import Any
 
-import boto3
+import numpy as np
 import pandas as pd
 from dateutil import parser
 from loguru import logger
-from thefuzz import fuzz
+from pandas.tseries.api import guess_datetime_format
+from rapidfuzz import fuzz, process
 from types_boto3_s3.client import S3Client
 from types_boto3_textract.client import TextractClient
 
-from inukai.validate.application_form_validator import read_json_from_s3
+from inukai.validate.application_form_validator import (
+    get_client,
+    read_json_from_s3,
+)
 from inukai.validate.validation_classes import CriteriaResult, ValidationResult
 
 COST_KEYWORDS = frozenset(
@@ -38,39 +45,101 @@ DATE_KEYWORDS = frozenset(["date"])
 DESCRIPTION_KEYWORDS = frozenset(["description", "detail"])
 
 
+def _keyword_pattern(keywords: frozenset[str]) -> re.Pattern[str]:
+    return re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+
+
+_COST_RE = _keyword_pattern(COST_KEYWORDS)
+_DATE_RE = _keyword_pattern(DATE_KEYWORDS)
+_DESCRIPTION_RE = _keyword_pattern(DESCRIPTION_KEYWORDS)
+
+# Polling schedule for asynchronous Textract jobs, in seconds
+POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 16.0
+JOB_TIMEOUT = 600.0
+
+
+def match_date_and_cost(
+    dates: np.ndarray, costs: np.ndarray, target_date: int, target_cost: float
+) -> np.ndarray:
+    """
+    Boolean mask of the rows dated target_date (in days since the epoch) with
+    the given cost
+    """
+    return (dates == target_date) & (costs == target_cost)
+
+
 class BankStatementProcessor:
     textract_client: TextractClient
     application_form: dict[str, str]
     bucket_name: str
     document: str
     s3: S3Client
+    date_format: str | None
 
     def __init__(
         self,
         application_form_address: dict[str, str],
         bank_statement_address: dict[str, str],
         region_name: str,
+        s3: S3Client | None = None,
+        application_form: dict[str, str] | None = None,
     ) -> None:
-        self.s3 = boto3.client("s3")
-        self.textract_client = boto3.client("textract", region_name=region_name)
-        self.application_form = read_json_from_s3(
-            application_form_address["s3_bucket"],
-            application_form_address["filename"],
-            self.s3,
-        )
+        self.s3 = s3 if s3 is not None else get_client("s3")
+        self.textract_client = get_client("textract", region_name)
+        if application_form is None:
+            application_form = read_json_from_s3(
+                application_form_address["s3_bucket"],
+                application_form_address["filename"],
+                self.s3,
+            )
+        self.application_form = application_form
         self.bucket_name = bank_statement_address["s3_bucket"]
         self.document = bank_statement_address["filename"]
+        # Set by normalize_df from the statement's Date column
+        self.date_format = None
 
     def analyze_document_with_tables(
         self, document_location: dict[str, dict[str, str]]
     ) -> dict[str, dict[str, Any] | list[Any]]:
         """
-        Analyze the bank statement with Textract and extract the table data
+        Analyze the bank statement with Textract's asynchronous API, which supports
+        multi-page documents, and collect the blocks of every result page
         """
-        response = self.textract_client.analyze_document(
-            Document=document_location, FeatureTypes=["TABLES"]
-        )
-        return response
+        job_id = self.textract_client.start_document_analysis(
+            DocumentLocation=document_location, FeatureTypes=["TABLES"]
+        )["JobId"]
+        response = self.wait_for_document_analysis(job_id)
+
+        blocks = list(response["Blocks"])
+        while "NextToken" in response:
+            response = self.textract_client.get_document_analysis(
+                JobId=job_id, NextToken=response["NextToken"]
+            )
+            blocks.extend(response["Blocks"])
+        return {"Blocks": blocks}
+
+    def wait_for_document_analysis(self, job_id: str) -> dict[str, Any]:
+        """
+        Poll a Textract job with exponential backoff until it finishes
+        """
+        interval = POLL_INTERVAL
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while True:
+            response = self.textract_client.get_document_analysis(JobId=job_id)
+            status = response["JobStatus"]
+            if status in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+                if status == "PARTIAL_SUCCESS":
+                    logger.warning(f"Textract job {job_id} only partially succeeded")
+                return response
+            if status == "FAILED":
+                raise RuntimeError(
+                    f"Textract job {job_id} failed: {response.get('StatusMessage')}"
+                )
+            if time.monotonic() + interval > deadline:
+                raise TimeoutError(f"Textract job {job_id} did not finish in time")
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
 
     @staticmethod
     def parse_textract_table(
@@ -79,40 +148,72 @@ class BankStatementProcessor:
         """
         Parse the Textract response to extract table data
         """
-        blocks = response["Blocks"]
-        cells = [block for block in blocks if block["BlockType"] == "CELL"]
-        items = {
-            block["Id"]: block
-            for block in blocks
-            if block["BlockType"] in ["WORD", "LINE"]
-        }
+        # Work on the blocks column-wise rather than probing each block dict
+        blocks = pd.DataFrame(response["Blocks"]).reindex(
+            columns=[
+                "Id",
+                "BlockType",
+                "Text",
+                "RowIndex",
+                "ColumnIndex",
+                "Relationships",
+            ]
+        )
+        if not (blocks["BlockType"] == "CELL").any():
+            return []
+        id_to_text = blocks.loc[
+            blocks["BlockType"].isin(["WORD", "LINE"]), ["Id", "Text"]
+        ].set_index("Id")["Text"]
+
+        # One row per (parent block, child id) CHILD relationship
+        relations = blocks.loc[
+            blocks["BlockType"].isin(["TABLE", "CELL"]),
+            ["Id", "BlockType", "Relationships"],
+        ].explode("Relationships", ignore_index=True)
+        relations = relations.dropna(subset=["Relationships"])
+        relations = pd.concat(
+            [
+                relations[["Id", "BlockType"]].reset_index(drop=True),
+                pd.json_normalize(relations["Relationships"].tolist()).reindex(
+                    columns=["Type", "Ids"]
+                ),
+            ],
+            axis=1,
+        )
+        children = relations.loc[relations["Type"] == "CHILD"].explode("Ids")
 
-        table_data = {}
-        for cell in cells:
-            row = cell["RowIndex"]
-            col = cell["ColumnIndex"]
-
-            text = ""
-            if "Relationships" in cell:
-                for relation in cell["Relationships"]:
-                    if relation["Type"] == "CHILD":
-                        for child_id in relation["Ids"]:
-                            if child_id in items:
-                                text += items[child_id]["Text"] + " "
-
-            text = text.strip()
-            if row not in table_data:
-                table_data[row] = {}
-            table_data[row][col] = text
-
-        table_rows = []
-        for row in sorted(table_data.keys()):
-            row_data = []
-            for col in sorted(table_data[row].keys()):
-                row_data.append(table_data[row][col])
-            table_rows.append(row_data)
-
-        return table_rows
+        # Multi-page statements have one table per page, keep them apart
+        table_children = children.loc[children["BlockType"] == "TABLE"]
+        table_number = table_children["Id"].map(
+            {table_id: n for n, table_id in enumerate(table_children["Id"].unique(), 1)}
+        )
+        cell_to_table = pd.Series(table_number.to_numpy(), index=table_children["Ids"])
+
+        cell_children = children.loc[children["BlockType"] == "CELL"]
+        cell_text = (
+            cell_children.assign(Text=cell_children["Ids"].map(id_to_text))
+            .dropna(subset=["Text"])
+            .groupby("Id", sort=False)["Text"]
+            .agg(" ".join)
+        )
+
+        cells = blocks.loc[
+            blocks["BlockType"] == "CELL", ["Id", "RowIndex", "ColumnIndex"]
+        ]
+        triples = pd.DataFrame(
+            {
+                "table": cells["Id"].map(cell_to_table).fillna(0).astype(int),
+                "row": cells["RowIndex"],
+                "col": cells["ColumnIndex"],
+                "text": cells["Id"].map(cell_text).fillna(""),
+            }
+        )
+
+        # Later cells overwrite earlier ones at the same position
+        table = triples.drop_duplicates(
+            subset=["table", "row", "col"], keep="last"
+        ).pivot(index=["table", "row"], columns="col", values="text")
+        return table.fillna("").to_numpy().tolist()
 
     @staticmethod
     def table_to_dataframe(table_rows: list[list[str]]) -> pd.DataFrame:
@@ -120,7 +221,8 @@ class BankStatementProcessor:
         Convert table rows to a DataFrame
         """
         headers = table_rows[0]
-        data = table_rows[1:]
+        # Tables on later pages usually repeat the header row
+        data = [row for row in table_rows[1:] if row != headers]
         df = pd.DataFrame(data, columns=headers)
         return df
 
@@ -135,12 +237,11 @@ class BankStatementProcessor:
 
         # Match headers to categories
         for header in headers:
-            lower_header = header.lower()
-            if any(keyword in lower_header for keyword in DATE_KEYWORDS):
+            if _DATE_RE.search(header):
                 header_mapping["Date"] = header
-            elif any(keyword in lower_header for keyword in DESCRIPTION_KEYWORDS):
+            elif _DESCRIPTION_RE.search(header):
                 header_mapping["Description"] = header
-            elif any(keyword in lower_header for keyword in COST_KEYWORDS):
+            elif _COST_RE.search(header):
                 header_mapping["Cost"] = header
 
         # Check for missing mappings
@@ -162,15 +263,39 @@ class BankStatementProcessor:
             return None
 
     @staticmethod
-    def normalize_cost(cost_str: str) -> float:
+    def guess_date_format(dates: pd.Series) -> str | None:
+        """
+        Guess the statement's date format from its first date. Formats without
+        a year are not used, since dateutil fills in the current year for them
+        """
+        sample = dates[dates.notna() & (dates != "")]
+        if sample.empty:
+            return None
+        # pandas warns when the guess is day first; that is expected for UK
+        # statements, and the form's date is parsed with the same format
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            date_format = guess_datetime_format(sample.iloc[0])
+        if date_format is None or not ("%Y" in date_format or "%y" in date_format):
+            return None
+        return date_format
+
+    @classmethod
+    def parse_dates(cls, dates: pd.Series, date_format: str | None) -> pd.Series:
         """
-        Normalize the cost column format
+        Parse dates with the statement's format in one vectorized pass. Dates
+        that don't fit it are parsed one by one with normalize_date
         """
-        if cost_str == "":
-            return 0.0
-        cost_str = cost_str.replace("£", "")
-        cost_str = cost_str.replace("$", "")
-        return float(cost_str.replace(",", ""))
+        if date_format is None:
+            parsed = pd.Series(pd.NaT, index=dates.index, dtype="datetime64[ns]")
+        else:
+            parsed = pd.to_datetime(dates, errors="coerce", format=date_format)
+        failed = parsed.isna() & dates.notna() & (dates != "")
+        if failed.any():
+            parsed[failed] = pd.to_datetime(
+                dates[failed].map(cls.normalize_date), errors="coerce"
+            )
+        return parsed
 
     def normalize_df(self, df: pd.DataFrame) -> None:
         """
@@ -180,16 +305,15 @@ class BankStatementProcessor:
         header_mapper = self.map_headers(df.columns)
         df.rename(columns=header_mapper, inplace=True)
 
-        # Normalize date and cost in the DataFrame
-        df["Date"] = df["Date"].apply(lambda s: self.normalize_date(s))
-        df["Cost"] = df["Cost"].apply(lambda s: self.normalize_cost(s))
-
-    @staticmethod
-    def validate_business_name(description: str, business_name: str) -> int:
-        """
-        Validate product using fuzzy matching
-        """
-        return fuzz.partial_ratio(description, business_name)
+        # Normalize date and cost in the DataFrame, whole columns at a time
+        self.date_format = self.guess_date_format(df["Date"])
+        df["Date"] = self.parse_dates(df["Date"], self.date_format).dt.normalize()
+        df["Cost"] = (
+            df["Cost"]
+            .str.replace(r"[£$,]", "", regex=True)
+            .replace("", "0")
+            .astype("float64")
+        )
 
     def find_matching_rows(
         self, bank_statement_df: pd.DataFrame, threshold: int = 80
@@ -198,24 +322,38 @@ class BankStatementProcessor:
         Find any rows on the bank statement that matches the application form
         """
         # Extract validation criteria from the application form
-        target_date = self.normalize_date(self.application_form["purchase_date"])
-        target_cost = self.application_form["cost"]
+        # Parse the claimed date the same way as the statement's Date column
+        target_date = self.parse_dates(
+            pd.Series([self.application_form["purchase_date"]]), self.date_format
+        ).iloc[0]
+        target_cost = float(self.application_form["cost"])
         target_business_name = self.application_form["business_name"]
 
         # Find rows with the same date and cost as claimed on the application form
-        matching_rows = bank_statement_df[
-            (bank_statement_df["Date"] == target_date)
-            & (bank_statement_df["Cost"] == float(target_cost))
-        ]
-
-        # Validate product name similarity
-        matching_rows["Business Name Match"] = matching_rows["Description"].apply(
-            lambda x: self.validate_business_name(x, target_business_name)
+        if pd.isna(target_date):
+            return bank_statement_df.iloc[0:0]
+        mask = match_date_and_cost(
+            bank_statement_df["Date"].to_numpy(dtype="datetime64[D]").view("int64"),
+            bank_statement_df["Cost"].to_numpy(dtype="float64"),
+            np.datetime64(target_date.date(), "D").astype("int64"),
+            target_cost,
+        )
+        candidates = np.flatnonzero(mask)
+
+        # Validate business name similarity on the candidate rows at once
+        scores = process.cdist(
+            bank_statement_df["Description"].to_numpy()[candidates],
+            [target_business_name],
+            scorer=fuzz.partial_ratio,
+            workers=-1,
+        ).ravel()
+        # thefuzz rounded partial_ratio to an int, keep its threshold behaviour
+        scores = np.round(scores).astype(int)
+        is_valid = scores >= threshold
+
+        return bank_statement_df.iloc[candidates[is_valid]].assign(
+            **{"Business Name Match": scores[is_valid]}
         )
-
-        valid_rows = matching_rows[matching_rows["Business Name Match"] >= threshold]
-
-        return valid_rows
 
     def validate_statement(self) -> ValidationResult:
         """
@@ -24,5 +24,11 @@ from inukai.validate.application_validation import main as main_validation
     default="INFO",
     help="Set the logging level.",
 )
-def main(bucket_name, file_key, log_level):
-    main_validation(bucket_name, file_key, log_level)
\ No newline at end of file
+@click.option(
+    "--fast-fail",
+    is_flag=True,
+    default=False,
+    help="Skip the image check when the photo's geotag does not match the address.",
+)
+def main(bucket_name, file_key, log_level, fast_fail):
+    main_validation(bucket_name, file_key, log_level, fast_fail)
\ No newline at end of file
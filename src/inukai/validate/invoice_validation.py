@@ -1,28 +1,80 @@
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from typing import Any
 
-import boto3
-import torch
-import transformers
-from textractor import Textractor
-from textractor.data.constants import TextractFeatures
-from textractor.data.text_linearization_config import TextLinearizationConfig
+import httpx
+import orjson
+from dateutil import parser
+from loguru import logger
+from rapidfuzz import fuzz, utils
 from types_boto3_s3.client import S3Client
 from types_boto3_textract.client import TextractClient
 
-from inukai.validate.application_form_validator import read_json_from_s3
+from inukai.validate.application_form_validator import (
+    get_client,
+    read_cached_json_from_s3,
+)
 from inukai.validate.validation_classes import CriteriaResult, ValidationResult
 
 LLAMA_MODEL = "meta-llama/Meta-Llama-3-8B-Instruct"
+# Markdown-style prefixes for headings and layout elements left out of the text
+LAYOUT_PREFIXES = {"LAYOUT_TITLE": "# ", "LAYOUT_SECTION_HEADER": "## "}
+HIDDEN_LAYOUTS = frozenset(["LAYOUT_FIGURE"])
+
+# Invoice fields and the application form entries they are checked against
+INVOICE_FIELDS = {
+    "date": "purchase_date",
+    "model": "model",
+    "cost": "cost",
+    "address": "address",
+    "business_name": "business_name",
+}
+# Textract query answers below this confidence are left to LLaMA
+QUERY_MIN_CONFIDENCE = 80.0
+# token_sort_ratio above which free-text answers count as a match
+FUZZY_MATCH_THRESHOLD = 85
+# Fields where a near miss is a different product or company, e.g. a 14kW
+# and an 18kW heat pump, so only identical tokens count as a match
+EXACT_MATCH_FIELDS = frozenset(["model", "business_name"])
+COST_RE = re.compile(r"[^\d.\-]")
+# Two defaults differing in year, month and day, to detect partial dates
+DATE_DEFAULTS = (datetime(2000, 1, 1), datetime(2001, 2, 2))
+
+VALIDATION_VALUES = frozenset(["MATCH", "MISMATCH", "NOT GIVEN"])
+VALIDATION_RE = re.compile(r'"(\w+)":\s*"(MATCH|MISMATCH|NOT GIVEN)"')
+
+# Retries for transient failures when calling the LLaMA server
+LLAMA_RETRIES = 3
+LLAMA_BACKOFF = 2.0
+LLAMA_TIMEOUT = 120.0
+# Matches the number of sequences the server batches together
+LLAMA_MAX_CONCURRENCY = 32
+
+INVOICE_PROMPT_TEMPLATE = (
+    "Application form:\n"
+    "Business Name: {business_name}\n"
+    "Model: {model}\n"
+    "Purchase Date: {purchase_date}\n"
+    "Cost: {cost}\n"
+    "Address: {address}\n\n"
+    "Invoice:\n{document_text}\n\n"
+    "Does each application form field match the invoice? Reply "
+    "with only this JSON, each value MATCH or MISMATCH:\n"
+    "{response_format}"
+)
+
+_HTTP_CLIENT = httpx.Client(timeout=LLAMA_TIMEOUT)
 
 
 class InvoiceProcessor:
     textract_client: TextractClient
-    extractor: Textractor
     bucket_name: str
     document: str
     application_form: dict[str, dict[str, Any]] | dict[str, str]
     queries: dict[str, str]
+    llama_url: str
     s3: S3Client
 
     def __init__(
@@ -31,162 +83,427 @@ class InvoiceProcessor:
         invoice_address: dict[str, str],
         region_name: str,
         queries: dict[str, str],
+        llama_url: str,
+        s3: S3Client | None = None,
+        application_form: dict[str, dict[str, Any]] | dict[str, str] | None = None,
     ) -> None:
-        self.textract_client = boto3.client("textract", region_name=region_name)
-        self.s3 = boto3.client("s3")
-        self.extractor = Textractor(region_name=region_name)
+        self.textract_client = get_client("textract", region_name)
+        self.s3 = s3 if s3 is not None else get_client("s3")
         self.bucket_name = invoice_address["s3_bucket"]
         self.document = invoice_address["filename"]
-        self.application_form = read_json_from_s3(
-            application_form_address["s3_bucket"],
-            application_form_address["filename"],
-            self.s3,
-        )
+        if application_form is None:
+            application_form = read_cached_json_from_s3(
+                application_form_address["s3_bucket"],
+                application_form_address["filename"],
+                self.s3,
+            )
+        self.application_form = application_form
         self.queries = queries
+        self.llama_url = llama_url
 
-    def analyze_document_with_queries(
+    def analyze_document_full(
         self, document_location: dict[str, dict[str, str]]
     ) -> dict[str, Any]:
         """
-        Analyze the document using queries
+        Run the queries and the layout analysis in a single Textract call
         """
         response = self.textract_client.analyze_document(
             Document=document_location,
-            FeatureTypes=["QUERIES"],
+            FeatureTypes=["QUERIES", "LAYOUT"],
             QueriesConfig={
                 "Queries": [{"Text": query} for query in self.queries.keys()]
             },
         )
-        return response
+        return {
+            "queries_answers": self.parse_queries_response(response),
+            "linearized_text": self.linearize_layout(response),
+        }
 
-    def parse_queries_response(self, response: dict[str, Any]) -> list[str]:
+    def parse_queries_response(self, response: dict[str, Any]) -> list[dict[str, Any]]:
         """
         Parse queries response
         """
-        blocks = response["Blocks"]
-        output = []
-
-        for block in blocks:
+        # Join each QUERY to its QUERY_RESULT by id, Textract does not
+        # guarantee the result follows the query
+        queries = []
+        results = {}
+        for block in response["Blocks"]:
             if block["BlockType"] == "QUERY":
-                query_text = block["Query"]["Text"]
-                output.append({"Query": self.queries[query_text], "Answer": None})
+                queries.append(block)
             elif block["BlockType"] == "QUERY_RESULT":
-                answer_text = block.get("Text", "")
-                output[-1]["Answer"] = answer_text
+                results[block["Id"]] = block
+
+        output = []
+        for query in queries:
+            answer_ids = [
+                answer_id
+                for relation in query.get("Relationships", [])
+                if relation["Type"] == "ANSWER"
+                for answer_id in relation["Ids"]
+            ]
+            # Keep the most confident answer when there are several
+            answer = max(
+                (results[i] for i in answer_ids if i in results),
+                key=lambda result: result.get("Confidence", 0.0),
+                default={},
+            )
+            output.append(
+                {
+                    "Query": self.queries[query["Query"]["Text"]],
+                    "Answer": answer.get("Text", "") if answer else None,
+                    "Confidence": answer.get("Confidence"),
+                }
+            )
         return output
 
-    def parse_document_layout(self) -> str:
+    @staticmethod
+    def linearize_layout(response: dict[str, Any]) -> str:
         """
-        Extract layout-preserved text from a document
+        Turn Textract LAYOUT blocks into text, one paragraph per layout element
+        in reading order, with headings prefixed
         """
-        config = TextLinearizationConfig(
-            hide_figure_layout=True, title_prefix="# ", section_header_prefix="## "
-        )
+        blocks = {block["Id"]: block for block in response["Blocks"]}
+
+        def child_ids(block: dict[str, Any]) -> list[str]:
+            return [
+                child_id
+                for relation in block.get("Relationships", [])
+                if relation["Type"] == "CHILD"
+                for child_id in relation["Ids"]
+            ]
+
+        def lines(block: dict[str, Any]) -> list[str]:
+            # Lists nest LAYOUT_TEXT elements, everything else holds LINEs
+            text = []
+            for child_id in child_ids(block):
+                child = blocks.get(child_id)
+                if child is None:
+                    continue
+                if child["BlockType"] == "LINE":
+                    text.append(child["Text"])
+                elif child["BlockType"].startswith("LAYOUT_"):
+                    text.append(" ".join(lines(child)))
+            return text
+
+        layouts = [
+            block
+            for block in response["Blocks"]
+            if block["BlockType"].startswith("LAYOUT_")
+        ]
+        nested = {
+            child_id
+            for block in layouts
+            for child_id in child_ids(block)
+            if blocks.get(child_id, {}).get("BlockType", "").startswith("LAYOUT_")
+        }
+
+        paragraphs = []
+        for block in layouts:
+            if block["Id"] in nested or block["BlockType"] in HIDDEN_LAYOUTS:
+                continue
+            separator = "\n" if block["BlockType"] == "LAYOUT_LIST" else " "
+            text = separator.join(lines(block))
+            if text:
+                paragraphs.append(LAYOUT_PREFIXES.get(block["BlockType"], "") + text)
+        return "\n\n".join(paragraphs)
 
-        document = self.extractor.analyze_document(
-            file_source=f"s3://{self.bucket_name}/{self.document}",
-            features=[TextractFeatures.LAYOUT],
-            save_image=True,
+    @staticmethod
+    def parse_cost(cost: Any) -> float | None:
+        """
+        Parse a cost such as "£1,299.00" into a number
+        """
+        try:
+            return float(COST_RE.sub("", str(cost)))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_date(date_str: Any) -> date | None:
+        """
+        Parse a date in any format dateutil understands. Returns None when it
+        cannot be parsed, when day and month could be read either way, e.g.
+        03/12/2024, or when the year, month or day is missing, e.g. March 2024
+        """
+        date_str = str(date_str)
+        try:
+            return datetime.fromisoformat(date_str).date()
+        except ValueError:
+            pass
+        # dateutil fills missing parts from the default, so a partial date
+        # parses differently under the two defaults
+        try:
+            readings = {
+                parser.parse(date_str, dayfirst=dayfirst, default=default).date()
+                for dayfirst in (False, True)
+                for default in DATE_DEFAULTS
+            }
+        except (ValueError, OverflowError):
+            return None
+        return readings.pop() if len(readings) == 1 else None
+
+    @classmethod
+    def compare_field(cls, key: str, form_value: Any, answer: str) -> bool | None:
+        """
+        Compare an application form value with a Textract query answer.
+        Returns None when it cannot decide, leaving the field to LLaMA
+        """
+        if key == "cost":
+            form_cost, answer_cost = cls.parse_cost(form_value), cls.parse_cost(answer)
+            if form_cost is None or answer_cost is None:
+                return None
+            return abs(form_cost - answer_cost) < 0.01
+        if key == "date":
+            form_date, answer_date = cls.parse_date(form_value), cls.parse_date(answer)
+            if form_date is None or answer_date is None:
+                return None
+            return form_date == answer_date
+        if key in EXACT_MATCH_FIELDS:
+            form_tokens = sorted(utils.default_process(str(form_value)).split())
+            answer_tokens = sorted(utils.default_process(answer).split())
+            return True if form_tokens == answer_tokens else None
+        # Free-text fields are worded differently on invoices, so only a close
+        # match is decisive. token_sort_ratio rather than token_set_ratio, which
+        # scores a partial answer such as just the town as a full match
+        score = fuzz.token_sort_ratio(
+            str(form_value), answer, processor=utils.default_process
         )
+        return True if score > FUZZY_MATCH_THRESHOLD else None
 
-        return document.get_text(config=config)
+    def resolve_with_queries(
+        self, queries_answers: list[dict[str, Any]]
+    ) -> dict[str, bool]:
+        """
+        Decide the invoice fields that the Textract query answers settle
+        without LLaMA
+        """
+        resolved = {}
+        for answer in queries_answers:
+            key = answer["Query"]
+            confidence = answer["Confidence"] or 0.0
+            if (
+                key not in INVOICE_FIELDS
+                or not answer["Answer"]
+                or confidence < QUERY_MIN_CONFIDENCE
+            ):
+                continue
+            form_value = self.application_form.get(INVOICE_FIELDS[key])
+            if form_value is None:
+                continue
+            match = self.compare_field(key, form_value, answer["Answer"])
+            if match is not None:
+                resolved[key] = match
+        logger.debug(f"Resolved from Textract queries: {resolved}")
+        return resolved
 
     def extract_validation(self, response: str) -> dict[str, str]:
         """
         Extract validation results from LLaMA response
         """
-        pattern = r'"(\w+)":\s+"(MATCH|MISMATCH|NOT GIVEN)"'
-        matches = re.findall(pattern, response)
-        result = {key: value for key, value in matches}
-        return result
+        # The prompt asks for a JSON object, parse it directly when it is valid
+        start, end = response.find("{"), response.rfind("}") + 1
+        try:
+            data = orjson.loads(response[start:end])
+        except orjson.JSONDecodeError:
+            data = None
+        if isinstance(data, dict):
+            return {
+                key: value
+                for key, value in data.items()
+                if isinstance(value, str) and value in VALIDATION_VALUES
+            }
 
-    @staticmethod
-    def request_to_llama(messages: list[dict[str, str]]) -> str:
+        return dict(VALIDATION_RE.findall(response))
+
+    def request_to_llama(self, messages: list[dict[str, str]]) -> str:
         """
         Send a request to the LLaMA server containing the message parameter
         """
+        # The server wraps the content in a single user message
+        content = "\n".join(msg["content"] for msg in messages)
 
-        pipeline = transformers.pipeline(
-            "text-generation",
-            model=LLAMA_MODEL,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            device_map="auto",
-        )
+        for attempt in range(LLAMA_RETRIES):
+            try:
+                response = _HTTP_CLIENT.post(
+                    f"{self.llama_url}/generate", json={"content": content}
+                )
+                response.raise_for_status()
+                return response.json()["response"]
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # Client errors will fail the same way on every attempt
+                client_error = (
+                    isinstance(e, httpx.HTTPStatusError)
+                    and e.response.status_code < 500
+                )
+                if client_error or attempt == LLAMA_RETRIES - 1:
+                    raise
+                delay = LLAMA_BACKOFF**attempt
+                logger.warning(f"LLaMA request failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
+        raise RuntimeError("LLAMA_RETRIES must be at least 1")
 
-        terminators = [
-            pipeline.tokenizer.eos_token_id,
-            pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+    @staticmethod
+    def build_messages(
+        application_form: dict[str, dict[str, Any]] | dict[str, str],
+        document_text: str,
+        fields: list[str] | None = None,
+    ) -> list[dict[str, str]]:
+        """
+        Build the LLaMA prompt comparing an application form with an invoice,
+        asking only about the given fields
+        """
+        if fields is None:
+            fields = list(INVOICE_FIELDS)
+        response_format = orjson.dumps(dict.fromkeys(fields, "")).decode()
+        return [
+            {
+                "role": "user",
+                "content": INVOICE_PROMPT_TEMPLATE.format_map(
+                    {
+                        **application_form,
+                        "document_text": document_text,
+                        "response_format": response_format,
+                    }
+                ),
+            }
         ]
 
-        # Combine messages into a single string prompt
-        prompt = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+    def to_validation_result(
+        self, response_text: str, resolved: dict[str, bool] | None = None
+    ) -> ValidationResult:
+        """
+        Turn the LLaMA response, and any fields already resolved without it,
+        into a validation result. Fields LLaMA did not answer score as
+        mismatches
+        """
+        validation_result = ValidationResult(component_name="invoice")
+        resolved = resolved or {}
+        answers = self.extract_validation(response_text)
 
-        outputs = pipeline(
-            prompt,
-            max_new_tokens=256,
-            eos_token_id=terminators,
-            do_sample=True,
-            temperature=0.6,
-            top_p=0.9,
-        )
+        for key in INVOICE_FIELDS:
+            if key in resolved:
+                value = resolved[key]
+            elif key in answers:
+                value = answers[key] == "MATCH"
+            else:
+                logger.warning(f"No answer from LLaMA for invoice field {key}")
+                value = False
+            validation_result.add_criteria(CriteriaResult(key=key, value=value))
 
-        return outputs[0]["generated_text"]
+        return validation_result
 
     def validate_document(
         self,
         application_form: dict[str, dict[str, Any]] | dict[str, str],
         document_text: str,
+        resolved: dict[str, bool] | None = None,
     ) -> ValidationResult:
         """
-        Validate the invoice against application form using LLaMA model
+        Validate the invoice against application form using LLaMA model. Fields
+        in resolved are already decided and are not sent to LLaMA
         """
-        validation_result = ValidationResult(component_name="invoice")
-        fields = (
-            f"Business Name: {application_form['business_name']}\n"
-            f"Model: {application_form['model']}\n"
-            f"Purchase Date: {application_form['purchase_date']}\n"
-            f"Cost: {application_form['cost']}\n"
-            f"Address: {application_form['address']}\n\n"
-        )
-        json_structure = (
-            "{\n"
-            '  "date": "MATCH/MISMATCH",\n'
-            '  "model": "MATCH/MISMATCH",\n'
-            '  "cost": "MATCH/MISMATCH",\n'
-            '  "address": "MATCH/MISMATCH",\n'
-            '  "business_name": "MATCH/MISMATCH"\n'
-            "}\n\n"
-        )
+        return self.validate_documents(
+            [(application_form, document_text)], [resolved or {}]
+        )[0]
 
-        messages = [
-            {
-                "role": "user",
-                "content": (
-                    f"I have the following information from an application form:\n\n{fields}"
-                    f"I want you to compare this information to the text of the following invoice "
-                    f"and tell me if the information matches the above. "
-                    f"Here is the invoice text:\n\n{document_text}\n\n"
-                    "Use a structured format for your answer using the following template:\n\n"
-                    f"{json_structure}"
-                    "Please fill in the values based on the document. Your answer should be MATCH or MISMATCH."
-                ),
-            }
-        ]
+    def validate_documents(
+        self,
+        pairs: list[tuple[dict[str, dict[str, Any]] | dict[str, str], str]],
+        resolved: list[dict[str, bool]] | None = None,
+    ) -> list[ValidationResult]:
+        """
+        Validate several (application form, invoice text) pairs with LLaMA. The
+        requests are sent together so the server can batch them on the GPU, and
+        pairs whose fields are all resolved skip LLaMA
+        """
+        if not pairs:
+            return []
+        if resolved is None:
+            resolved = [{}] * len(pairs)
 
-        # send a request to the llama server
-        response_text = self.request_to_llama(messages)
-        response_dict = self.extract_validation(response_text)
+        requests = {}
+        for i, ((application_form, document_text), decided) in enumerate(
+            zip(pairs, resolved)
+        ):
+            fields = [key for key in INVOICE_FIELDS if key not in decided]
+            if fields:
+                requests[i] = self.build_messages(
+                    application_form, document_text, fields
+                )
 
-        for key, value in response_dict.items():
-            validation_result.add_criteria(
-                CriteriaResult(key=key, value=(value == "MATCH"))
-            )
+        response_texts = {}
+        if requests:
+            with ThreadPoolExecutor(
+                max_workers=min(len(requests), LLAMA_MAX_CONCURRENCY)
+            ) as executor:
+                response_texts = dict(
+                    zip(
+                        requests, executor.map(self.request_to_llama, requests.values())
+                    )
+                )
+        return [
+            self.to_validation_result(response_texts.get(i, ""), decided)
+            for i, decided in enumerate(resolved)
+        ]
 
-        return validation_result
+    def analyze_invoice(self) -> dict[str, Any]:
+        """
+        Run the combined Textract analysis on this processor's invoice
+        """
+        document_location = {
+            "S3Object": {"Bucket": self.bucket_name, "Name": self.document}
+        }
+        return self.analyze_document_full(document_location)
 
     def run_invoice_processing(self) -> ValidationResult:
         """
         Extract and validate the invoice
         """
-        invoice_text = self.parse_document_layout()
-        return self.validate_document(self.application_form, invoice_text)
+        analysis = self.analyze_invoice()
+        resolved = self.resolve_with_queries(analysis["queries_answers"])
+        return self.validate_document(
+            self.application_form, analysis["linearized_text"], resolved
+        )
+
+    @classmethod
+    def run_batch(
+        cls,
+        pairs: list[tuple[dict[str, str], dict[str, str]]],
+        region_name: str,
+        queries: dict[str, str],
+        llama_url: str,
+        max_workers: int = 16,
+    ) -> list[ValidationResult]:
+        """
+        Extract and validate several invoices, given as (application form
+        address, invoice address) pairs. The S3 and Textract calls of the
+        invoices overlap, and the LLaMA requests are sent as one batch
+        """
+        if not pairs:
+            return []
+
+        def analyze(
+            pair: tuple[dict[str, str], dict[str, str]],
+        ) -> tuple["InvoiceProcessor", dict[str, Any]]:
+            application_form_address, invoice_address = pair
+            processor = cls(
+                application_form_address=application_form_address,
+                invoice_address=invoice_address,
+                region_name=region_name,
+                queries=queries,
+                llama_url=llama_url,
+            )
+            return processor, processor.analyze_invoice()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            analyzed = list(executor.map(analyze, pairs))
+
+        return analyzed[0][0].validate_documents(
+            [
+                (processor.application_form, analysis["linearized_text"])
+                for processor, analysis in analyzed
+            ],
+            [
+                processor.resolve_with_queries(analysis["queries_answers"])
+                for processor, analysis in analyzed
+            ],
+        )
@@ -1,19 +1,52 @@
-import torch
-import transformers
+import uuid
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from transformers import AutoTokenizer
+from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+
+# A single vLLM engine batches concurrent requests continuously, so run the
+# app with one uvicorn worker, e.g. `uvicorn llama-server:app --workers 1`
+model_id = "casperhansen/llama-3-8b-instruct-awq"
+tokenizer = AutoTokenizer.from_pretrained(model_id)
+engine = AsyncLLMEngine.from_engine_args(
+    AsyncEngineArgs(
+        model=model_id,
+        quantization="awq",
+        dtype="float16",
+        max_num_seqs=32,
+    )
+)
 
-# Initialize the pipeline once
-model_id = "meta-llama/Meta-Llama-3-8B-Instruct"
-pipeline = transformers.pipeline(
-    "text-generation",
-    model=model_id,
-    model_kwargs={"torch_dtype": torch.bfloat16},
-    device_map="auto",
+TERMINATORS = [
+    tokenizer.eos_token_id,
+    tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+]
+# The answer is a ~60 token JSON object, stop as soon as it is closed
+SAMPLING_PARAMS = SamplingParams(
+    max_tokens=96,
+    stop=["}"],
+    include_stop_str_in_output=True,
+    stop_token_ids=TERMINATORS,
+    # Greedy decoding, the answer is categorical
+    temperature=0,
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Run one short generation so the first real request does not pay for any
+    # remaining lazy setup
+    async for _ in engine.generate(
+        "Hello", SamplingParams(max_tokens=1), request_id="warm-up"
+    ):
+        pass
+    yield
+
+
 # Create a FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 class Message(BaseModel):
@@ -21,20 +54,18 @@ class Message(BaseModel):
 
 
 @app.post("/generate")
-def generate_text(message: Message):
+async def generate_text(message: Message):
     try:
-        terminators = [
-            pipeline.tokenizer.eos_token_id,
-            pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
-        ]
-        outputs = pipeline(
+        prompt = tokenizer.apply_chat_template(
             [{"role": "user", "content": message.content}],
-            max_new_tokens=256,
-            eos_token_id=terminators,
-            do_sample=True,
-            temperature=0.6,
-            top_p=0.9,
+            add_generation_prompt=True,
+            tokenize=False,
         )
-        return {"response": outputs[0]["generated_text"]}
+        final_output = None
+        async for output in engine.generate(
+            prompt, SAMPLING_PARAMS, request_id=str(uuid.uuid4())
+        ):
+            final_output = output
+        return {"response": final_output.outputs[0].text}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,35 +1,62 @@
+from array import array
+
+import numpy as np
+
+
 class CriteriaResult:
+    __slots__ = ("key", "value", "weight", "_score")
+
     key: str
     value: str | bool
     weight: float
+    _score: int
 
     def __init__(self, key: str, value: str | bool, weight: float = 1):
         self.key = key
         self.value = value
         self.weight = weight
+        # Converts "true"/"false" into a numerical score (1 for "true", 0 for
+        # "false") once, so bad values fail at construction
+        if isinstance(value, bool):
+            self._score = 1 if value else 0
+        elif isinstance(value, str):
+            self._score = 1 if value.lower() == "true" else 0
+        else:
+            raise ValueError(f"Score value must be true or false, not {value}")
 
     def score(self) -> int:
-        """Converts "true"/"false" into a numerical score (1 for "true", 0 for "false")"""
-        if isinstance(self.value, bool):
-            return 1 if self.value else 0
-        elif isinstance(self.value, str):
-            return 1 if self.value.lower() == "true" else 0
-        else:
-            raise ValueError(f"Score value must be true or false, not {self.value}")
+        """Numerical score computed at construction (1 for "true", 0 for "false")"""
+        return self._score
 
 
 class ValidationResult:
+    __slots__ = ("component_name", "criteria", "_scores", "_weights", "_total_weight")
+
     component_name: str
     criteria: list[CriteriaResult]
+    _scores: array
+    _weights: array
+    _total_weight: float
 
     def __init__(self, component_name: str) -> None:
         self.component_name = component_name
         self.criteria = []
+        # Scores and weights are kept side by side so scoring is one dot product
+        self._scores = array("b")
+        self._weights = array("d")
+        self._total_weight = 0.0
 
     def add_criteria(self, criteria_result: CriteriaResult) -> None:
         self.criteria.append(criteria_result)
+        self._scores.append(criteria_result.score())
+        self._weights.append(criteria_result.weight)
+        self._total_weight += criteria_result.weight
 
     def weighted_score(self) -> float:
-        total_weighted_score = sum(c.score() * c.weight for c in self.criteria)
-        total_weight = sum(c.weight for c in self.criteria)
-        return total_weighted_score / total_weight if total_weight != 0 else 0
+        if self._total_weight == 0:
+            return 0
+        total_weighted_score = np.dot(
+            np.frombuffer(self._scores, dtype=np.int8),
+            np.frombuffer(self._weights, dtype=np.float64),
+        )
+        return float(total_weighted_score) / self._total_weight